@@ -0,0 +1,26 @@
+# Numba version of the BulkData paquets builder, see PixelLink.use_numba
+# Requires the numba and numpy packages
+
+import numpy as np
+from numba import njit
+
+
+@njit(cache=True)
+def _pack(data, message_type, payload_size):
+    count = (len(data) + payload_size - 1) // payload_size
+    frames = np.empty(len(data) + 4 * count, np.uint8)
+    for i in range(count):
+        offset = i * payload_size
+        size = min(len(data) - offset, payload_size)
+        start = i * (4 + payload_size)
+        frames[start] = message_type
+        frames[start + 1] = size
+        frames[start + 2] = offset & 0xff
+        frames[start + 3] = offset >> 8
+        frames[start+4:start+4+size] = data[offset:offset+size]
+    return frames
+
+
+def pack_bulk_frames(data: bytes, message_type: int, payload_size) -> bytes:
+    """Same as pixels._build_bulk_frames(), all the frames back to back in offset order"""
+    return _pack(np.frombuffer(data, np.uint8), message_type, payload_size).tobytes()
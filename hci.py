@@ -0,0 +1,75 @@
+# Helpers to tune the Bluetooth adapter (Linux only)
+
+import struct
+import socket
+import fcntl
+import subprocess
+
+# Connection parameters we ask for when connecting to dices
+# Intervals are in units of 1.25ms and supervision timeout in units of 10ms
+CONN_MIN_INTERVAL = 6 # 7.5ms, the minimum allowed by the spec
+CONN_MAX_INTERVAL = 6
+CONN_LATENCY = 0
+SUPERVISION_TIMEOUT = 500 # 5s
+
+# Default LE connection parameters used by the kernel for new connections
+# (see net/bluetooth/hci_debugfs.c in the Linux sources)
+_DEBUGFS_PATH = "/sys/kernel/debug/bluetooth/hci{}/{}"
+
+# Raw HCI constants, see bluez lib/hci.h
+_HCI_COMMAND_PKT = 0x01
+_LE_LINK = 0x80
+_HCIGETCONNINFO = 0x800448d5 # _IOR('H', 213, int)
+_OGF_LE_CTL = 0x08
+_OCF_LE_CONN_UPDATE = 0x0013
+_LE_CONN_UPDATE = struct.Struct('<BHBHHHHHHH')
+
+
+def set_default_connection_parameters(hci_index = 0):
+    """Writes our connection parameters in the kernel debugfs so they are used for the next connections.
+    Requires debugfs to be mounted and root access, returns False if the parameters couldn't be written"""
+    # Min before max, the kernel rejects a min interval greater than the current max one
+    values = [
+        ("conn_min_interval", CONN_MIN_INTERVAL),
+        ("conn_max_interval", CONN_MAX_INTERVAL),
+        ("conn_latency", CONN_LATENCY),
+        ("supervision_timeout", SUPERVISION_TIMEOUT),
+    ]
+    try:
+        for name, value in values:
+            with open(_DEBUGFS_PATH.format(hci_index, name), "w") as f:
+                f.write(str(value))
+        return True
+    except OSError:
+        return False
+
+
+def update_connection_parameters(address: str, hci_index = 0):
+    """Sends a LE Connection Update HCI command for an existing connection.
+    Requires the CAP_NET_RAW capability, returns False if the command couldn't be sent"""
+    try:
+        with socket.socket(socket.AF_BLUETOOTH, socket.SOCK_RAW, socket.BTPROTO_HCI) as sock:
+            sock.bind((hci_index,))
+
+            # Retrieve the connection handle, bdaddr is stored in reverse order
+            # The connection info follows the 8 bytes (with padding) request header
+            bdaddr = bytes(int(b, 16) for b in reversed(address.split(":")))
+            req = bytearray(bdaddr + bytes([_LE_LINK]) + bytes(1 + 16))
+            fcntl.ioctl(sock.fileno(), _HCIGETCONNINFO, req)
+            handle = struct.unpack_from('<H', req, 8)[0]
+
+            opcode = (_OGF_LE_CTL << 10) | _OCF_LE_CONN_UPDATE
+            sock.send(_LE_CONN_UPDATE.pack(_HCI_COMMAND_PKT, opcode, 14, handle,
+                CONN_MIN_INTERVAL, CONN_MAX_INTERVAL, CONN_LATENCY, SUPERVISION_TIMEOUT, 0, 0))
+        return True
+    except (OSError, AttributeError):
+        # AttributeError is raised on platforms without Bluetooth socket support
+        return False
+
+
+def reset_adapter(hci_index = 0):
+    """Resets the adapter with hciconfig, returns False if the reset failed"""
+    try:
+        return subprocess.run(["hciconfig", f"hci{hci_index}", "reset"]).returncode == 0
+    except OSError:
+        return False
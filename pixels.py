@@ -8,16 +8,18 @@ import threading
 import traceback
 import sys
 import signal
-from queue import Queue
+import struct
+from queue import Queue, Empty
 
 # Our types
-from utils import integer_to_bytes, Event
+from utils import Event
 from color import Color32
 from animation import AnimationSet
+import hci
 
 # We're using the bluepy lib for easy bluetooth access
 # https://github.com/IanHarvey/bluepy
-from bluepy.btle import Scanner, ScanEntry, Peripheral, DefaultDelegate
+from bluepy.btle import Scanner, ScanEntry, Peripheral, DefaultDelegate, BTLEManagementError
 
 
 # Known issues:
@@ -33,6 +35,7 @@ from bluepy.btle import Scanner, ScanEntry, Peripheral, DefaultDelegate
 # bluepy.btle.BTLEManagementError: Failed to execute management command 'scanend' (code: 11, error: Rejected)
 # https://github.com/zewelor/bt-mqtt-gateway/issues/59
 # > sudo hciconfig hci0 reset
+# Pixels.enumerate_pixels() does this reset automatically and scans again
 
 
 @unique
@@ -97,10 +100,47 @@ class MessageType(IntEnum):
     Count = 47
 
 
+# Message names by identifier, used for tracing without constructing a MessageType
+_MESSAGE_NAMES = {m.value: m.name for m in MessageType}
+
+# Battery voltage is sent as a little endian float
+_BATTERY = struct.Struct('<f')
+
+# BulkSetup message: message type, size of the data to transfer
+_BULK_SETUP = struct.Struct('<BH')
+
+# Message type followed by a color (and optional byte fields), colors are sent as little endian 32 bits RGB values
+_COLOR = struct.Struct('<BI')
+_LED_COLOR = struct.Struct('<BBI')
+_FACE_COLOR = struct.Struct('<BBBBBI')
+
+# BulkData header: message type, payload size, offset
+_BULK_DATA_HEADER = struct.Struct('<BBH')
+
+# TransferAnimSet message: palette size, keyframe count, rgb track count, track count, animation count, heat track index
+_TRANSFER_ANIM_SET = struct.Struct('<BHHHHHH')
+
+
+def _build_bulk_frames(data: bytes, payload_size) -> bytes:
+    """Splits data in BulkData messages, returns all the frames back to back in offset order.
+    Frame i starts at i * (4 + payload_size), only the last frame may be shorter.
+    Frame layout: message type, payload size, offset (2 bytes), payload"""
+    if PixelLink.use_numba:
+        from bulk_data_numba import pack_bulk_frames
+        return pack_bulk_frames(data, int(MessageType.BulkData), payload_size)
+
+    frames = bytearray()
+    for offset in range(0, len(data), payload_size):
+        size = min(len(data) - offset, payload_size)
+        frames += _BULK_DATA_HEADER.pack(MessageType.BulkData, size, offset)
+        frames += data[offset:offset+size]
+    return bytes(frames)
+
+
 class PixelLink:
     """
     Connection to a specific Pixel dice over Bluetooth
-    This class is not thread safe (because bluepy.btle.Peripheral is not)
+    The bluepy peripheral is only accessed from the dice own thread (because bluepy.btle.Peripheral is not thread safe)
     """
 
     # Pixels Bluetooth constants
@@ -112,12 +152,19 @@ class PixelLink:
     # so we're stuck making sure our BulkData paquet fits in the 20 byte, i.e. 16 bytes of payload
     PIXELS_MESSAGE_BULK_DATA_SIZE = 16
 
+    # Maximum number of BulkData paquets sent to the dice before waiting for their acknowledgement
+    PIXELS_BULK_DATA_WINDOW = 4
+
     # Default timeout in seconds used for waiting on a dice message
     DEFAULT_TIMEOUT = 3
 
     # Set to true to print messages content
     _trace = False
 
+    # Set to true to split bulk data in paquets with numba (requires numba and numpy).
+    # Only worth it for very large data sets, the first upload pays for the JIT compilation
+    use_numba = False
+
     _devices = []
 
     @staticmethod
@@ -132,12 +179,24 @@ class PixelLink:
         self._device = None
         self._subscriber = None
         self._writer = None
+        self._write_handle = None
+
+        # Thread owning the peripheral and queue of commands it processes
+        self._thread = None
+        self._command_queue = Queue()
+
+        # When connected with bleak rather than bluepy
+        self._client = None
+        self._write_lock = None
 
         # Create the message map
         self._message_map = {}
         for i in range(MessageType.Count):
             self._message_map[i] = []
 
+        # Messages we're waiting an ack for, ack type => (single slot list receiving the message, event set on reception)
+        self._ack_waiters = {}
+
         # Setup events
         self.face_up_changed = Event()
         self.battery_voltage_changed = Event()
@@ -185,51 +244,72 @@ class PixelLink:
             # not sure if I should throw or just return the condition...
             raise Exception("Timeout while waiting for condition")
 
-    def _send(self, message_type: MessageType, *args):
+    def _send(self, message_type: MessageType, *args, with_response = False):
+        """ Sends a message to the dice, with_response requests an acknowledgement at the ATT level
+        (bluepy write request) rather than the default write command """
+        self._send_raw(bytes([message_type, *args]), with_response)
+
+    def _send_raw(self, frame: bytes, with_response = False):
+        """ Sends an already formatted message (message type followed by its data) to the dice """
         if PixelLink._trace:
-            print(f'{self.name} <= {message_type.name}: {", ".join([format(i, "02x") for i in args])}')
-        Pixels.send_data(self, message_type, *args)
+            print(f'{self.name} <= {_MESSAGE_NAMES.get(frame[0], frame[0])}: {", ".join([format(i, "02x") for i in frame[1:]])}')
+        Pixels.send_data(self, frame, with_response)
+
+    async def _send_and_ack(self, msg_type: MessageType, msg_data, ack_type: MessageType, timeout = DEFAULT_TIMEOUT, with_response = False):
+        return await self._send_raw_and_ack(bytes([msg_type, *msg_data]), ack_type, timeout, with_response)
 
-    async def _send_and_ack(self, msg_type: MessageType, msg_data, ack_type: MessageType, timeout = DEFAULT_TIMEOUT):
+    async def _send_raw_and_ack(self, frame: bytes, ack_type: MessageType, timeout = DEFAULT_TIMEOUT, with_response = False):
+        """ Sends an already formatted message and waits for the dice to answer with the given ack message """
         assert(timeout >= 0)
-        self._send(msg_type, *msg_data)
-        ack_msg = None
-        def on_message(self, msg):
-            nonlocal ack_msg
-            if not ack_msg and msg[0] == ack_type:
-                ack_msg = msg
-        self._message_map[ack_type].append(on_message)
+        # Register the slot before sending so we can't miss the ack
+        slot = [None]
+        event = threading.Event()
+        waiter = (slot, event)
+        self._ack_waiters[ack_type] = waiter
         try:
-            await self._wait_until(lambda: ack_msg != None, timeout)
+            self._send_raw(frame, with_response)
+            # Block on a worker thread so the event loop keeps running (bleak dices are serviced by one)
+            if not await asyncio.get_running_loop().run_in_executor(None, event.wait, timeout):
+                raise Exception(f"Timeout while waiting for {ack_type.name}")
         finally:
-            self._message_map[ack_type].remove(on_message)
-        return ack_msg
+            if self._ack_waiters.get(ack_type) is waiter:
+                del self._ack_waiters[ack_type]
+        return slot[0]
 
-    def _process_message(self, msg):
+    def _process_message(self, msg: bytes):
         """Processes a message coming for the device and routes it to the proper message handler"""
         if PixelLink._trace:
-            print(f'{self.name} => {MessageType(msg[0]).name}: {", ".join([format(i, "02x") for i in msg[1:]])}')
+            print(f'{self.name} => {_MESSAGE_NAMES.get(msg[0], msg[0])}: {", ".join([format(i, "02x") for i in msg[1:]])}')
 
+        # Pass the message to the handlers, most messages don't have any
         handlers = self._message_map.get(msg[0])
-        for handler in handlers:
-            if handler != None:
-                # Pass the message to the handler
+        if handlers:
+            for handler in handlers:
                 handler(self, msg)
 
+        # Then fill the slot of anyone waiting on this message and wake them up,
+        # once the handlers have updated the dice state the waiter may read
+        waiter = self._ack_waiters.get(msg[0])
+        if waiter != None:
+            slot, event = waiter
+            if slot[0] == None:
+                slot[0] = msg
+                event.set()
+
     def _die_type_handler(self, msg):
         self._dtype = DiceType(msg[1])
 
     def _debug_log_handler(self, msg):
         endl = msg[1:].index(0) + 1 # find index of string terminator
-        print(f'DEBUG[{self.address}]: {bytes(msg[1:endl]).decode("utf-8")}')
+        print(f'DEBUG[{self.address}]: {msg[1:endl].decode("utf-8")}')
 
     def _battery_level_handler(self, msg):
-        import struct
-        voltage = struct.unpack('<f', bytes(msg[1:])) #little endian
+        voltage = _BATTERY.unpack_from(msg, 1)[0]
         #print(f'Battery voltage: {voltage}')
         if self._battery_voltage != voltage:
             self._battery_voltage = voltage
-            self.battery_voltage_changed.notify(voltage)
+            if self.battery_voltage_changed.has_callbacks:
+                self.battery_voltage_changed.notify(voltage)
 
     def _state_handler(self, msg):
         state = msg[1]
@@ -238,12 +318,13 @@ class PixelLink:
         face = face + 1 if state == 1 else 0
         if self._face_up != face:
             self._face_up = face
-            self.face_up_changed.notify(face)
+            if self.face_up_changed.has_callbacks:
+                self.face_up_changed.notify(face)
 
     def _notify_user_handler(self, msg):
         assert(msg[0] == MessageType.NotifyUser)
         timeout, ok, cancel = msg[1:4]
-        txt = bytes(msg[4:]).decode("utf-8")
+        txt = msg[4:].decode("utf-8")
         can_abort = ok and cancel
         txt_key = 'Enter to continue, any other key to abort' if can_abort else 'Any key to continue'
         print(f'{txt} [{txt_key}, timeout {timeout}s]:')
@@ -257,31 +338,84 @@ class PixelLink:
     async def _upload_bulk_data(self, data: bytes, progress_callback, timeout = DEFAULT_TIMEOUT):
         assert(len(data))
         assert(timeout >= 0)
+        # Build all the BulkData paquets upfront in one buffer, retransmissions reuse them
+        frames = _build_bulk_frames(bytes(data), PixelLink.PIXELS_MESSAGE_BULK_DATA_SIZE)
+
         # Send setup message
-        await self._send_and_ack(MessageType.BulkSetup, integer_to_bytes(len(data), 2), MessageType.BulkSetupAck, timeout)
-        # Then transfer data
+        await self._send_raw_and_ack(_BULK_SETUP.pack(MessageType.BulkSetup, len(data)), MessageType.BulkSetupAck, timeout, with_response=True)
+
+        # Then transfer data, keeping up to PIXELS_BULK_DATA_WINDOW paquets in flight
+        # so we don't pay for a full Bluetooth round-trip on every paquet
         total_size = len(data)
-        remainingSize = total_size
-        offset = 0
-        while remainingSize > 0:
-            size = min(remainingSize, PixelLink.PIXELS_MESSAGE_BULK_DATA_SIZE)
-            header = [size] + integer_to_bytes(offset, 2)
-            await self._send_and_ack(MessageType.BulkData, header + data[offset:offset+size], MessageType.BulkDataAck, timeout)
-            if progress_callback != None:
-                progress_callback(offset, total_size)
-            remainingSize -= size
-            offset += size
+        window = PixelLink.PIXELS_BULK_DATA_WINDOW
+        pending = {} # offset => time at which the paquet was (last) sent
+        pending_changed = threading.Condition() # notified by the dice thread on each ack
+        acked_size = 0
+
+        def send_data(offset):
+            # Register the paquet before sending it as the ack may come back right away
+            with pending_changed:
+                pending[offset] = time.perf_counter()
+            # BulkData paquets are acknowledged by the dice, no need for an ATT level ack on top of it
+            start = (offset // PixelLink.PIXELS_MESSAGE_BULK_DATA_SIZE) * (4 + PixelLink.PIXELS_MESSAGE_BULK_DATA_SIZE)
+            self._send_raw(frames[start:start + 4 + PixelLink.PIXELS_MESSAGE_BULK_DATA_SIZE], with_response=False)
+
+        def on_ack(self, msg):
+            # Called from the dice thread, the dice echoes the offset of the paquet it received
+            nonlocal acked_size
+            offset = msg[1] | (msg[2] << 8)
+            with pending_changed:
+                if pending.pop(offset, None) is None:
+                    return # Ack for a paquet we've already retransmitted and got acknowledged
+                acked_size += min(total_size - offset, PixelLink.PIXELS_MESSAGE_BULK_DATA_SIZE)
+                pending_changed.notify_all()
+
+        def wait_for(condition):
+            with pending_changed:
+                return pending_changed.wait_for(condition, timeout)
+
+        self._message_map[MessageType.BulkDataAck].append(on_ack)
+        try:
+            loop = asyncio.get_running_loop()
+            offset = 0
+            retransmit_acked_size = None
+            while offset < total_size or len(pending) > 0:
+                # Fill up the window
+                while offset < total_size and len(pending) < window:
+                    send_data(offset)
+                    offset += PixelLink.PIXELS_MESSAGE_BULK_DATA_SIZE
+
+                # Wait for a slot to free up, or for the last acks
+                if offset < total_size:
+                    condition = lambda: len(pending) < window
+                else:
+                    condition = lambda: len(pending) == 0
+                # Block on a worker thread so the event loop keeps running, like _send_raw_and_ack()
+                if not await loop.run_in_executor(None, wait_for, condition):
+                    # Give up if nothing got acknowledged since our last retransmission
+                    if retransmit_acked_size == acked_size:
+                        raise Exception("Timeout while waiting for BulkDataAck")
+                    retransmit_acked_size = acked_size
+                    now = time.perf_counter()
+                    with pending_changed:
+                        stale = [o for o, t in pending.items() if now - t >= timeout]
+                    for o in stale:
+                        send_data(o)
+
+                if progress_callback != None:
+                    progress_callback(acked_size, total_size)
+        finally:
+            self._message_map[MessageType.BulkDataAck].remove(on_ack)
 
     async def upload_animation_set(self, anim_set: AnimationSet, timeout = DEFAULT_TIMEOUT):
-        data = []
-        def append(dword):
-            data.extend(integer_to_bytes(dword, 2))
-        append(len(anim_set.palette))
-        append(len(anim_set.keyframes))
-        append(len(anim_set.rgb_tracks))
-        append(len(anim_set.tracks))
-        append(len(anim_set.animations))
-        append(anim_set.heat_track_index)
+        # Heat track index is -1 when there is no heat animation, which the dice reads as 0xffff
+        frame = _TRANSFER_ANIM_SET.pack(MessageType.TransferAnimSet,
+            len(anim_set.palette),
+            len(anim_set.keyframes),
+            len(anim_set.rgb_tracks),
+            len(anim_set.tracks),
+            len(anim_set.animations),
+            anim_set.heat_track_index & 0xffff)
 
         update_percent_increment = 0.1
         next_update_percent = update_percent_increment
@@ -293,7 +427,7 @@ class PixelLink:
                 print(f"Uploading animation: {percent * 100:.2f}% complete")
                 next_update_percent += update_percent_increment
 
-        await self._send_and_ack(MessageType.TransferAnimSet, data, MessageType.TransferAnimSetAck, timeout)
+        await self._send_raw_and_ack(frame, MessageType.TransferAnimSetAck, timeout)
         await self._upload_bulk_data(anim_set.pack(), print_progress, timeout)
 
     def await_upload_animation_set(self, anim_set: AnimationSet, timeout = DEFAULT_TIMEOUT):
@@ -328,15 +462,11 @@ class PixelLink:
         self._send(MessageType.PlayAnimEvent, event, remap_face, loop)
 
     def force_LEDs_color(self, color: Color32):
-        c = integer_to_bytes(color.to_rgb(), 4)
-        self._send(MessageType.SetAllLEDsToColor, *c)
+        self._send_raw(_COLOR.pack(MessageType.SetAllLEDsToColor, color.to_rgb()))
 
     def force_LED_color(self, ledIndex, color: Color32):
         """ Led index starts at 0 """
-        data = []
-        data.extend(integer_to_bytes(ledIndex, 1))
-        data.extend(integer_to_bytes(color.to_rgb(), 4))
-        self._send(MessageType.SetLEDToColor, *data)
+        self._send_raw(_LED_COLOR.pack(MessageType.SetLEDToColor, ledIndex, color.to_rgb()))
 
     def start_calibration(self):
         self._send(MessageType.Calibrate)
@@ -345,13 +475,7 @@ class PixelLink:
         self._send(MessageType.PrintA2DReadings)
 
     def light_up_face(self, face, color: Color32, remapFace = 0, layoutIndex = 255, remapRot = 255):
-        data = []
-        data.extend(integer_to_bytes(face, 1))
-        data.extend(integer_to_bytes(remapFace, 1))
-        data.extend(integer_to_bytes(layoutIndex, 1))
-        data.extend(integer_to_bytes(remapRot, 1))
-        data.extend(integer_to_bytes(color.to_rgb(), 4))
-        self._send(MessageType.LightUpFace, *data)
+        self._send_raw(_FACE_COLOR.pack(MessageType.LightUpFace, face, remapFace, layoutIndex, remapRot, color.to_rgb()))
 
     def set_led_anim_state(self):
         self._send(MessageType.SetLEDAnimState)
@@ -361,33 +485,83 @@ class Pixels:
 
     @unique
     class Command(IntEnum):
+        """ Commands processed by the thread of a dice """
         _None = 0
-        AddPixel = 1
-        RemovePixel = 2
-        SendMessage = 3
-        TerminateThread = 4
-
-
-    command_queue = Queue()
+        SendMessage = 1
+        Disconnect = 2
 
     connected_pixels = []
     available_pixels = []
 
     DEFAULT_SCAN_TIMEOUT = 3
 
+    # How long in seconds a dice thread blocks on its command queue, then on bluepy notifications
+    PUMP_TIMEOUT = 0.005
+
+    # Management command status returned by the failing scan described in the known issues
+    _MGMT_STATUS_REJECTED = 11
+
+    # Indices of the adapters using our connection parameters by default for new connections
+    _default_connection_parameters = set()
+
+    # Event loop running the bleak clients, see enumerate_pixels_async()
+    _bleak_loop = None
+
     @staticmethod
-    def enumerate_pixels(timeout = DEFAULT_SCAN_TIMEOUT):
-        """Returns a list of Pixel dices discovered over Bluetooth"""
+    def enumerate_pixels(timeout = DEFAULT_SCAN_TIMEOUT, hci_indices = (0,)):
+        """Returns a list of Pixel dices discovered over Bluetooth.
+        Scans with all the given Bluetooth adapters at once, dices seen by several adapters are
+        spread across them based on their address so connections are shared between adapters."""
+        # Ask for a short connection interval for all the dices we're about to connect to,
+        # otherwise every message round-trip pays for the (long) default interval
+        Pixels._default_connection_parameters = set(i for i in hci_indices if hci.set_default_connection_parameters(i))
+
         print(f"Scanning BLE devices...")
-        scanned_devices = Scanner().scan(timeout)
+        scanned_devices = {} # hci index => devices
+        errors = {} # hci index => exception raised while scanning
+        def scan(index):
+            try:
+                try:
+                    scanned_devices[index] = Scanner(index).scan(timeout)
+                except BTLEManagementError as e:
+                    # Only the documented failure is fixed by a reset, see known issues at the top of this file
+                    if getattr(e, "estat", None) != Pixels._MGMT_STATUS_REJECTED:
+                        raise
+                    print(f"Scan rejected on hci{index}, resetting adapter")
+                    if not hci.reset_adapter(index):
+                        raise
+                    scanned_devices[index] = Scanner(index).scan(timeout)
+            except Exception as e:
+                errors[index] = e
+
+        threads = [threading.Thread(target=scan, args=(i,)) for i in hci_indices]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        # Report scan failures to the caller
+        for index in hci_indices:
+            if index in errors:
+                raise errors[index]
+
+        # Merge results by address
+        entries = {} # address => entries from each adapter
+        for index in hci_indices:
+            for dev in scanned_devices.get(index, []):
+                #print(f'Device {dev.addr} ({dev.addrType}), RSSI={dev.rssi} dB')
+                if dev.getValueText(7) == PixelLink.PIXELS_SERVICE_UUID:
+                    entries.setdefault(dev.addr, []).append(dev)
+
         Pixels.available_pixels.clear()
-        for dev in scanned_devices:
-            #print(f'Device {dev.addr} ({dev.addrType}), RSSI={dev.rssi} dB')
-            if dev.getValueText(7) == PixelLink.PIXELS_SERVICE_UUID:
-                # Grab full name if possible, otherwise short name
-                name = dev.getValueText(9) or dev.getValueText(8)
-                Pixels.available_pixels.append(dev)
-                print(f"Discovered Pixel {name}")
+        for addr, devs in entries.items():
+            # Pick the adapter that should connect to the dice, entry.iface is the adapter that saw it
+            preferred = hci_indices[int(addr[-2:], 16) % len(hci_indices)]
+            dev = next((d for d in devs if d.iface == preferred), devs[0])
+            # Grab full name if possible, otherwise short name
+            name = dev.getValueText(9) or dev.getValueText(8)
+            Pixels.available_pixels.append(dev)
+            print(f"Discovered Pixel {name}")
         return Pixels.available_pixels
 
     @staticmethod
@@ -417,120 +591,246 @@ class Pixels:
             nonlocal finished
             finished = True 
 
-        # Get the BLE thread to connect to the device. We do this so the native code helper is attached to the BLE thread, not this one
-        Pixels.command_queue.put([Pixels.Command.AddPixel, entry, dice, assigning_dev])
+        # Get the dice thread to connect to the device. We do this so the native code helper is attached to that thread, not this one
+        dice._thread = threading.Thread(target=Pixels._pixel_main, args=(dice, entry, assigning_dev))
+        dice._thread.start()
         while not finished:
             await asyncio.sleep(0)
 
         if dice._device != None:
-
-            # register default message handlers
-            dice._message_map[MessageType.IAmADie].append(PixelLink._die_type_handler)
-            dice._message_map[MessageType.DebugLog].append(PixelLink._debug_log_handler)
-            dice._message_map[MessageType.BatteryLevel].append(PixelLink._battery_level_handler)
-            dice._message_map[MessageType.State].append(PixelLink._state_handler)
-            dice._message_map[MessageType.NotifyUser].append(PixelLink._notify_user_handler)
-            
-            # Check type
-            dice._dtype = None
-            dice._send(MessageType.WhoAreYou)
-            await dice._wait_until(lambda : dice._dtype != None, 10)
-            if not dice._dtype:
-                raise Exception("Pixel type couldn't be identified")
-
-            # Battery level
-            dice._battery_voltage = -1
-            await dice.refresh_battery_voltage()
-
-            # Face up (0 means no face up)
-            dice._face_up = 0
-            await dice.refresh_state()
-
-            print(f"Dice {dice.name} connected")
+            # store the pixel
+            Pixels.connected_pixels.append(dice)
+            await Pixels._handshake(dice)
             return dice
         else:
             return None
 
+    @staticmethod
+    async def _handshake(dice: PixelLink):
+        """ Registers the default message handlers and queries the dice initial state """
+        # register default message handlers
+        dice._message_map[MessageType.IAmADie].append(PixelLink._die_type_handler)
+        dice._message_map[MessageType.DebugLog].append(PixelLink._debug_log_handler)
+        dice._message_map[MessageType.BatteryLevel].append(PixelLink._battery_level_handler)
+        dice._message_map[MessageType.State].append(PixelLink._state_handler)
+        dice._message_map[MessageType.NotifyUser].append(PixelLink._notify_user_handler)
+
+        # Check type
+        dice._dtype = None
+        await dice._send_and_ack(MessageType.WhoAreYou, [], MessageType.IAmADie, 10)
+        if not dice._dtype:
+            raise Exception("Pixel type couldn't be identified")
+
+        # Battery level
+        dice._battery_voltage = -1
+        await dice.refresh_battery_voltage()
+
+        # Face up (0 means no face up)
+        dice._face_up = 0
+        await dice.refresh_state()
+
+        print(f"Dice {dice.name} connected")
+
+    @staticmethod
+    async def enumerate_pixels_async(timeout = DEFAULT_SCAN_TIMEOUT):
+        """Discovers Pixel dices over Bluetooth using bleak and connects to all of them at once.
+        Returns the list of connected dices.
+        This is an alternative to enumerate_pixels() + connect_xxx() that connects with bleak rather
+        than bluepy. It needs the bleak package to be installed, bluepy is still imported by this module."""
+        # Bleak clients are bound to the event loop they were created on, so we run them all
+        # on a dedicated loop (our BLE thread) rather than on the caller's one(s)
+        future = asyncio.run_coroutine_threadsafe(Pixels._bleak_enumerate(timeout), Pixels._get_bleak_loop())
+        return await asyncio.wrap_future(future)
+
+    @staticmethod
+    def await_enumerate_pixels_async(timeout = DEFAULT_SCAN_TIMEOUT):
+        """ Kicks off a task to discover and connect Pixel dices using bleak and waits for it to complete """
+        return asyncio.run(Pixels.enumerate_pixels_async(timeout))
+
+    @staticmethod
+    def _get_bleak_loop():
+        if Pixels._bleak_loop == None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, daemon=True).start()
+            Pixels._bleak_loop = loop
+        return Pixels._bleak_loop
+
+    @staticmethod
+    async def _bleak_enumerate(timeout):
+        from bleak import BleakScanner
+
+        # Bleak doesn't tell which adapter it's using, assume the default one
+        Pixels._default_connection_parameters = {0} if hci.set_default_connection_parameters() else set()
+
+        print(f"Scanning BLE devices...")
+        scanned_devices = await BleakScanner.discover(timeout=timeout, return_adv=True)
+        matches = []
+        for dev, adv in scanned_devices.values():
+            if PixelLink.PIXELS_SERVICE_UUID in adv.service_uuids:
+                name = adv.local_name or dev.name
+                matches.append((dev, name))
+                print(f"Discovered Pixel {name}")
+
+        # Connect to all the dices concurrently
+        results = await asyncio.gather(*(Pixels._bleak_connect(dev, name) for dev, name in matches), return_exceptions=True)
+        dices = []
+        for (dev, name), result in zip(matches, results):
+            if isinstance(result, PixelLink):
+                dices.append(result)
+            else:
+                print(f"Failed to connect to dice {name}: {result}")
+        return dices
+
+    @staticmethod
+    async def _bleak_connect(device, name) -> PixelLink:
+        from bleak import BleakClient
+
+        dice = PixelLink()
+        dice._address = device.address
+        dice._name = name
+
+        print(f"Connecting to dice {dice._name} at address {dice._address}")
+        client = BleakClient(device)
+        await client.connect()
+        try:
+            # Writes are serialized so the dice gets them in order
+            dice._write_lock = asyncio.Lock()
+            await client.start_notify(PixelLink.PIXELS_SUBSCRIBE_CHARACTERISTIC, lambda _, data: dice._process_message(bytes(data)))
+            dice._client = client
+
+            # Fall back to updating the parameters of this connection
+            if 0 not in Pixels._default_connection_parameters:
+                if not hci.update_connection_parameters(dice._address):
+                    print(f"Couldn't update connection parameters for dice {dice._name}")
+
+            Pixels.connected_pixels.append(dice)
+            await Pixels._handshake(dice)
+        except:
+            if dice in Pixels.connected_pixels:
+                Pixels.connected_pixels.remove(dice)
+            await client.disconnect()
+            raise
+        return dice
+
+    @staticmethod
+    async def _bleak_write(pixel: PixelLink, data: bytes, with_response):
+        async with pixel._write_lock:
+            await pixel._client.write_gatt_char(PixelLink.PIXELS_WRITE_CHARACTERISTIC, data, response=with_response)
+
+    @staticmethod
+    def _disconnect(pixel: PixelLink):
+        """ Returns the future of the disconnection for bleak dices, None for bluepy ones """
+        if pixel._client != None:
+            return asyncio.run_coroutine_threadsafe(pixel._client.disconnect(), Pixels._bleak_loop)
+        else:
+            pixel._command_queue.put([Pixels.Command.Disconnect])
+            return None
+
+    @staticmethod
+    def _wait_disconnect(pixel: PixelLink, future, timeout = PixelLink.DEFAULT_TIMEOUT):
+        # The bleak loop thread is a daemon, make sure the links are closed before we may exit
+        if future != None:
+            try:
+                future.result(timeout)
+            except Exception as e:
+                print(f"Failed to disconnect dice {pixel.name}: {e!r}")
 
     @staticmethod
     def remove_pixel(pixel: PixelLink):
-        Pixels.command_queue.put([Pixels.Command.RemovePixel, pixel])
+        Pixels.connected_pixels.remove(pixel)
+        Pixels._wait_disconnect(pixel, Pixels._disconnect(pixel))
+
+    @staticmethod
+    def send_data(pixel: PixelLink, data: bytes, with_response = False):
+        if pixel._client != None:
+            future = asyncio.run_coroutine_threadsafe(Pixels._bleak_write(pixel, data, with_response), Pixels._bleak_loop)
+            def on_written(future):
+                if not future.cancelled() and future.exception() != None:
+                    print(f"Failed to write to dice {pixel.name}: {future.exception()!r}")
+            future.add_done_callback(on_written)
+        else:
+            pixel._command_queue.put([Pixels.Command.SendMessage, data, with_response])
 
     @staticmethod
-    def send_data(pixel: PixelLink, message_type: MessageType, *args):
-        Pixels.command_queue.put([Pixels.Command.SendMessage, pixel, message_type, *args])
+    def _connect(pixel: PixelLink, bluepy_entry: ScanEntry):
+        # create the device
+        pixel._address = bluepy_entry.addr
+        pixel._name = bluepy_entry.getValueText(9) or bluepy_entry.getValueText(8)
+        print(f"Connecting to dice {pixel._name} at address {pixel._address}")
+        pixel._device = Peripheral(bluepy_entry.addr, bluepy_entry.addrType, iface=bluepy_entry.iface)
+
+        try:
+            # Get connected_pixels service
+            service = pixel._device.getServiceByUUID(PixelLink.PIXELS_SERVICE_UUID)
+            if not service:
+                raise Exception('Pixel service not found')
+
+            # Get the subscriber and writer for exchanging data with the dice
+            pixel._subscriber = service.getCharacteristics(PixelLink.PIXELS_SUBSCRIBE_CHARACTERISTIC)[0]
+            pixel._writer = service.getCharacteristics(PixelLink.PIXELS_WRITE_CHARACTERISTIC)[0]
+
+            # Keep the handle around so we can write directly to the peripheral
+            pixel._write_handle = pixel._writer.valHandle
+
+            # This magic code enables notifications from the subscribe characteristic,
+            # which in turn keeps the firmware on the dice from erroring out because
+            # it thinks it can't send notifications. Note that firmware code has also been
+            # fixed so it won't crash as a result :)
+            # There is an example at the bottom of the file of notifications working
+            pixel._device.writeCharacteristic(pixel._subscriber.valHandle + 1, b'\x01\x00')
+
+            # Bluepy notification delegate
+            class ProcessMessageDelegate(DefaultDelegate):
+                def handleNotification(self, cHandle, data):
+                    pixel._process_message(data)
+            pixel._device.withDelegate(ProcessMessageDelegate())
+
+            # Fall back to updating the parameters of this connection
+            if bluepy_entry.iface not in Pixels._default_connection_parameters:
+                if not hci.update_connection_parameters(pixel._address, bluepy_entry.iface):
+                    print(f"Couldn't update connection parameters for dice {pixel._name}")
+        except:
+            pixel._device.disconnect()
+            raise
 
     @staticmethod
-    def _main():
+    def _pixel_main(pixel: PixelLink, bluepy_entry: ScanEntry, connected_callback):
+        """ Thread owning the bluepy peripheral of a dice, each dice gets its own thread
+        so their Bluetooth traffic doesn't wait on each other """
+        try:
+            Pixels._connect(pixel, bluepy_entry)
+        except:
+            pixel._device = None
+            print(traceback.format_exc())
+
+        # notify calling code
+        connected_callback(pixel._device)
+        if pixel._device == None:
+            return
+
+        # bluepy can't be woken up from waitForNotifications() when a command is queued,
+        # so we alternate between blocking on the command queue and on notifications,
+        # each wait returning as soon as there is something to process.
+        # waitForNotifications() only handles one notification at a time, so we don't block
+        # on the queue while notifications keep coming (i.e. during bursts)
+        got_notification = False
         while True:
             # process queue of messages
-            while Pixels.command_queue.qsize() > 0:
-                cmd = Pixels.command_queue.get(False)
-                if cmd[0] == Pixels.Command.AddPixel:
-                    # extract parameters
-                    bluepy_entry = cmd[1]
-                    pixel = cmd[2]
-
-                    # create the device
-                    # pixel = PixelLink()
-                    pixel._address = bluepy_entry.addr
-                    pixel._name = bluepy_entry.getValueText(9) or bluepy_entry.getValueText(8)
-                    pixel._device = Peripheral(bluepy_entry.addr, bluepy_entry.addrType)
-
-                    print(f"Connecting to dice {pixel._name} at address {pixel._address}")
-                    try:
-                        # Get connected_pixels service
-                        service = pixel._device.getServiceByUUID(PixelLink.PIXELS_SERVICE_UUID)
-                        if not service:
-                            raise Exception('Pixel service not found')
-
-                        # Get the subscriber and writer for exchanging data with the dice
-                        pixel._subscriber = service.getCharacteristics(PixelLink.PIXELS_SUBSCRIBE_CHARACTERISTIC)[0]
-                        pixel._writer = service.getCharacteristics(PixelLink.PIXELS_WRITE_CHARACTERISTIC)[0]
-
-                        # This magic code enables notifications from the subscribe characteristic,
-                        # which in turn keeps the firmware on the dice from erroring out because
-                        # it thinks it can't send notifications. Note that firmware code has also been
-                        # fixed so it won't crash as a result :)
-                        # There is an example at the bottom of the file of notifications working
-                        pixel._device.writeCharacteristic(pixel._subscriber.valHandle + 1, b'\x01\x00')
-
-                        # Bluepy notification delegate
-                        class ProcessMessageDelegate(DefaultDelegate):
-                            def handleNotification(self, cHandle, data):
-                                pixel._process_message(list(data))
-                        pixel._device.withDelegate(ProcessMessageDelegate())
-                    except:
+            try:
+                cmd = pixel._command_queue.get(not got_notification, Pixels.PUMP_TIMEOUT)
+                while True:
+                    if cmd[0] == Pixels.Command.SendMessage:
+                        data, with_response = cmd[1:]
+                        pixel._device.writeCharacteristic(pixel._write_handle, data, with_response)
+                    elif cmd[0] == Pixels.Command.Disconnect:
                         pixel._device.disconnect()
-                        pixel._device = None
-                        raise
+                        return
+                    cmd = pixel._command_queue.get(False)
+            except Empty:
+                pass
 
-                    # store the pixel
-                    Pixels.connected_pixels.append(pixel)
-
-                    # notify calling code
-                    cmd[3](pixel._device)
-                elif cmd[0] == Pixels.Command.RemovePixel:
-                    pixel = cmd[1]
-                    Pixels.connected_pixels.remove(pixel)
-                    pixel._device.disconnect()
-                elif cmd[0] == Pixels.Command.SendMessage:
-                    pixel = cmd[1]
-                    data = bytes(cmd[2:])
-                    pixel._writer.write(data)
-                elif cmd[0] == Pixels.Command.TerminateThread:
-                    # close all connections
-                    for pixel in Pixels.connected_pixels:
-                        pixel._device.disconnect()
-                    Pixels.connected_pixels.clear()
-                    return
-
-            # poll BLE stacks
-            for pixel in Pixels.connected_pixels:
-                pixel._device.waitForNotifications(0.0001) # 0 seems to cause issues
-
-            # wait before looping again
-            time.sleep(0.0001)
+            # poll BLE stack
+            got_notification = pixel._device.waitForNotifications(Pixels.PUMP_TIMEOUT)
 
     @staticmethod
     def start():
@@ -542,16 +842,16 @@ class Pixels:
 
         signal.signal(signal.SIGINT, signal_handler)
 
-        # kick off thread
-        t = threading.Thread(target=Pixels._main)
-        t.start()
-
         # start a scan!
         Pixels.enumerate_pixels()
 
     @staticmethod
     def terminate():
-        Pixels.command_queue.put([Pixels.Command.TerminateThread])
+        # close all connections, the bleak ones are closed concurrently
+        futures = [(pixel, Pixels._disconnect(pixel)) for pixel in Pixels.connected_pixels]
+        for pixel, future in futures:
+            Pixels._wait_disconnect(pixel, future)
+        Pixels.connected_pixels.clear()
 
     @staticmethod
     def is_in_interpreter():
@@ -583,7 +883,7 @@ async def main():
     #await pixels[0].upload_animation_set(AnimationSet.from_json_file('D20_animation_set.json'))
     # await dice2.refresh_battery_voltage()
 
-    # If we're in the interactive interpreter, don't terminate the BLE thread, use Ctrl-C instead
+    # If we're in the interactive interpreter, don't terminate the dice threads, use Ctrl-C instead
     # this way messages are still processed
     if not Pixels.is_in_interpreter():
         Pixels.terminate()
@@ -7,6 +7,11 @@ class Event:
     def __init__(self):
         self._callbacks = []
 
+    @property
+    def has_callbacks(self):
+        """ Whether any callback is attached, lets callers skip notify() when nothing is attached """
+        return len(self._callbacks) > 0
+
     def notify(self, *args, **kwargs):
         for cb in self._callbacks:
             cb(*args, **kwargs)